@@ -3,16 +3,22 @@
 # All Rights Reserved © Dr. Yousra Abdelatti, MD, MRCGP [INT]
 # Developed by Dr. Mohammedelnagi Mohammed
 
-import json
+from __future__ import annotations
+
+import mmap
 import os
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Tuple
 
-import pandas as pd
+import orjson
 import streamlit as st
 
-# Supabase SDK v2
-from supabase import create_client, Client
+# pandas/numpy and the Supabase SDK (v2) are imported where first needed, so the
+# signed-out landing page doesn't pay for them on a fresh worker.
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+    from supabase import Client
 
 # --------- App Constants ----------
 APP_TITLE = "Dr. Yousra Abdelatti — MRCGP AKT/CSA Preparations Platform"
@@ -21,6 +27,10 @@ DEV_FOOTER = "Developed by Dr. Mohammedelnagi Mohammed"
 
 BRAND_IMAGE = Path("assets/brand/DrYousra.jpg")
 ITEMS_PATH = Path("data/items.jsonl")
+OPTION_KEYS = ["A", "B", "C", "D", "E"]
+# Banks at or above this size are parsed from a read-only memory map
+ITEMS_MMAP_THRESHOLD = 1 << 20  # 1 MB
+ADMIN_USERS_PER_PAGE = 50
 
 # --------- Secrets / Config ----------
 SUPABASE_URL = st.secrets.get("SUPABASE_URL", "")
@@ -39,36 +49,158 @@ if not SUPABASE_URL or not SUPABASE_ANON_KEY:
     st.stop()
 
 # --------- Clients ----------
-def get_client_user() -> Client:
-    return create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+# Clients are built once and reused instead of a new HTTP session + TLS handshake
+# on every rerun. The anon client carries GoTrue auth state, so it is scoped to the
+# browser session; the service-role client holds no user session and is shared.
+def _store_auth_tokens(session) -> None:
+    st.session_state["auth_session"] = {
+        "access_token": session.access_token,
+        "refresh_token": session.refresh_token,
+    }
+
+def _clear_auth_state() -> None:
+    st.session_state["auth_user"] = None
+    st.session_state["auth_session"] = None
+    st.session_state["auth_client"] = None
+    st.session_state["session_attached"] = False
+
+def get_client_session() -> Client:
+    # A signed-in user's tokens are attached to this session's client at most once
+    client = st.session_state.get("auth_client")
+    if client is None:
+        from supabase import create_client
+        client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+        st.session_state["auth_client"] = client
+        st.session_state["session_attached"] = False
+    tokens = st.session_state.get("auth_session")
+    if tokens and st.session_state.get("auth_user"):
+        try:
+            if not st.session_state.get("session_attached"):
+                client.auth.set_session(tokens["access_token"], tokens["refresh_token"])
+                st.session_state["session_attached"] = True
+            # Auto-refresh rotates the refresh token, so re-read what the client holds
+            session = client.auth.get_session()
+        except Exception:
+            session = None
+        if session is None:
+            # Revoked/expired tokens: drop the login instead of failing every rerun
+            _clear_auth_state()
+            st.warning("Your session has expired. Please sign in again.")
+        else:
+            _store_auth_tokens(session)
+    return client
+
+@st.cache_resource(show_spinner=False)
+def _get_client_admin_cached(service_role_key: str) -> Client:
+    from supabase import create_client
+    return create_client(SUPABASE_URL, service_role_key)
 
 def get_client_admin() -> Optional[Client]:
     if not SUPABASE_SERVICE_ROLE_KEY:
         return None
-    return create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
-
-supabase_user = get_client_user()
-supabase_admin = get_client_admin()
+    return _get_client_admin_cached(SUPABASE_SERVICE_ROLE_KEY)
 
 # --------- Helpers ----------
-def load_items(jsonl_path: Path) -> pd.DataFrame:
-    if not jsonl_path.exists():
-        st.warning(f"Question bank not found at `{jsonl_path}`. Using empty dataset.")
-        return pd.DataFrame(columns=["case_id", "domain", "sub_specialty", "topic", "question", "options", "correct_answer", "explanation", "guideline_reference"])
-    rows = []
-    with jsonl_path.open("r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip():
-                rows.append(json.loads(line))
+@st.cache_data(persist="disk", max_entries=1, show_spinner=False)
+def _parse_items(path_str: str, mtime: float) -> pd.DataFrame:
+    # Persisted to disk per (path, mtime) so a fresh process skips the parse.
+    import pandas as pd
+    import pyarrow as pa
+    # orjson parses the raw UTF-8 bytes of each line directly (no str decode)
+    path = Path(path_str)
+    with path.open("rb") as f:
+        if path.stat().st_size >= ITEMS_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                rows = [orjson.loads(line) for line in iter(mm.readline, b"") if line.strip()]
+        else:
+            rows = [orjson.loads(line) for line in f if line.strip()]
     df = pd.DataFrame(rows)
-    # Normalize options dict to stable order A-E
+    # Split options into one column per key (options_A..options_E) once at load,
+    # so rendering reads columns in A-E order instead of re-ordering dicts per row
     if "options" in df.columns:
-        def order_opts(d):
-            keys = ["A", "B", "C", "D", "E"]
-            return {k: d[k] for k in keys if k in d}
-        df["options"] = df["options"].apply(lambda d: order_opts(d) if isinstance(d, dict) else d)
+        opts = pd.DataFrame([d if isinstance(d, dict) else {} for d in df["options"]], index=df.index)
+        for k in OPTION_KEYS:
+            df[f"options_{k}"] = opts[k] if k in opts.columns else None
+        df = df.drop(columns="options")
+    # Arrow-backed nested/string columns: contiguous buffers instead of per-row
+    # Python objects, which also keeps the cached/pickled frame compact. Explanation
+    # keys outside this schema are dropped by the struct cast.
+    arrow_types = {
+        "explanation": pa.struct([
+            pa.field("rationale", pa.string()),
+            pa.field("why_others_incorrect", pa.list_(pa.string())),
+        ]),
+        "guideline_reference": pa.list_(pa.string()),
+        **{f"options_{k}": pa.string() for k in OPTION_KEYS},
+    }
+    for col, arrow_type in arrow_types.items():
+        if col in df.columns:
+            try:
+                df[col] = pd.array(df[col].tolist(), dtype=pd.ArrowDtype(arrow_type))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                pass  # malformed values: keep the column as Python objects
     return df
 
+@st.cache_resource(show_spinner=False)
+def _items_state() -> Dict[str, Any]:
+    # Process-wide record of the (path, mtime) last loaded by _load_items_resource
+    return {}
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def _load_items_resource(path_str: str, mtime: float) -> pd.DataFrame:
+    # Cached per (path, mtime): editing the file busts the cache. Shared, not copied —
+    # callers must treat the returned DataFrame as read-only. The disk cache copy is
+    # unpickled once per process here rather than on every rerun.
+    state = _items_state()
+    if state.get("key") not in (None, (path_str, mtime)):
+        # The bank changed under this process. max_entries only bounds the in-memory
+        # layer of a disk cache, so drop the older pickles before parsing the new one.
+        # (Edits made while no process is running leave one stale pickle behind.)
+        _parse_items.clear()
+    state["key"] = (path_str, mtime)
+    return _parse_items(path_str, mtime)
+
+def items_mtime(jsonl_path: Path) -> Optional[float]:
+    # Stat once per rerun; (path, mtime) keys the frame and every cache derived from it
+    return jsonl_path.stat().st_mtime if jsonl_path.exists() else None
+
+def load_items(jsonl_path: Path, mtime: Optional[float]) -> pd.DataFrame:
+    if mtime is None:
+        import pandas as pd
+        st.warning(f"Question bank not found at `{jsonl_path}`. Using empty dataset.")
+        return pd.DataFrame(columns=["case_id", "domain", "sub_specialty", "topic", "question", "correct_answer", "explanation", "guideline_reference"] + [f"options_{k}" for k in OPTION_KEYS])
+    return _load_items_resource(str(jsonl_path), mtime)
+
+@st.cache_data(max_entries=1, show_spinner=False)
+def build_filter_index(path_str: str, mtime: float, _df: pd.DataFrame) -> Dict[str, Dict[str, np.ndarray]]:
+    # Positional row indices per filter value for the frame loaded from (path, mtime)
+    return {
+        "domain": _df.groupby("domain").indices,
+        "sub_specialty": _df.groupby("sub_specialty").indices,
+    }
+
+@st.cache_data(max_entries=1, show_spinner=False)
+def filter_choices(path_str: str, mtime: float, _df: pd.DataFrame) -> Tuple[List[str], List[str]]:
+    # Sorted distinct filter values, computed once per loaded (path, mtime)
+    return (
+        sorted(_df["domain"].dropna().unique().tolist()),
+        sorted(_df["sub_specialty"].dropna().unique().tolist()),
+    )
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def build_quiz_queue(path_str: str, mtime: float, dom_choice: str, sub_choice: str, _df: pd.DataFrame) -> List[Dict[str, Any]]:
+    # Matching questions as plain dicts, built once per (path, mtime, filters) and shared
+    # by every session — callers must treat the list and its rows as read-only
+    import numpy as np
+    index = build_filter_index(path_str, mtime, _df)
+    none = np.array([], dtype=np.intp)
+    positions = np.arange(len(_df))
+    if dom_choice != "All":
+        positions = index["domain"].get(dom_choice, none)
+    if sub_choice != "All":
+        positions = np.intersect1d(positions, index["sub_specialty"].get(sub_choice, none))
+    return _df.iloc[positions].to_dict(orient="records")
+
 def is_logged_in() -> bool:
     return st.session_state.get("auth_user") is not None
 
@@ -98,24 +230,26 @@ def footer():
 
 def init_session():
     st.session_state.setdefault("auth_user", None)
+    st.session_state.setdefault("auth_session", None)  # access/refresh tokens
     st.session_state.setdefault("quiz_index", 0)
-    st.session_state.setdefault("quiz_score", 0)
-    st.session_state.setdefault("responses", {})  # case_id -> chosen
+    st.session_state.setdefault("responses", {})  # case_id -> {"choice", "correct"}
 
 def sign_out():
     try:
-        supabase_user.auth.sign_out()
+        get_client_session().auth.sign_out()
     except Exception:
         pass
-    st.session_state["auth_user"] = None
+    _clear_auth_state()
     st.session_state["quiz_index"] = 0
-    st.session_state["quiz_score"] = 0
     st.session_state["responses"] = {}
 
 def sign_in(email: str, password: str) -> Optional[Dict[str, Any]]:
     try:
-        res = supabase_user.auth.sign_in_with_password({"email": email, "password": password})
-        # res.user, res.session
+        res = get_client_session().auth.sign_in_with_password({"email": email, "password": password})
+        # res.user, res.session — keep the tokens so reruns reuse this session
+        if res.session:
+            _store_auth_tokens(res.session)
+            st.session_state["session_attached"] = True
         return {"email": res.user.email, "id": res.user.id}
     except Exception as e:
         st.error(f"Sign-in failed: {e}")
@@ -123,20 +257,32 @@ def sign_in(email: str, password: str) -> Optional[Dict[str, Any]]:
 
 def sign_up(email: str, password: str) -> bool:
     try:
-        supabase_user.auth.sign_up({"email": email, "password": password})
+        get_client_session().auth.sign_up({"email": email, "password": password})
         return True
     except Exception as e:
         st.error(f"Sign-up failed: {e}")
         return False
 
-def admin_list_users() -> List[Dict[str, Any]]:
-    if not supabase_admin:
+@st.cache_data(ttl=30, show_spinner=False)
+def _cached_list_users(page: int, per_page: int = ADMIN_USERS_PER_PAGE) -> List[Dict[str, Any]]:
+    # Short-lived cache so panel reruns don't re-hit the Admin API; cleared on invite/delete.
+    # Errors propagate (and so are never cached); admin_list_users reports them.
+    res = get_client_admin().auth.admin.list_users(page=page, per_page=per_page)
+    # SDK v2 returns a list of User models; older shapes are a dict/object with 'users'
+    if isinstance(res, dict):
+        users = res.get("users", [])
+    elif isinstance(res, list):
+        users = res
+    else:
+        users = getattr(res, "users", [])
+    return [u if isinstance(u, dict) else {"id": getattr(u, "id", None), "email": getattr(u, "email", None)} for u in users]
+
+def admin_list_users(page: int = 1, per_page: int = ADMIN_USERS_PER_PAGE) -> List[Dict[str, Any]]:
+    if not get_client_admin():
         st.error("Admin functions require SUPABASE_SERVICE_ROLE_KEY in secrets.")
         return []
     try:
-        page = supabase_admin.auth.admin.list_users()
-        # page is a dict with 'users'
-        return page.get("users", []) if isinstance(page, dict) else getattr(page, "users", [])
+        return _cached_list_users(page, per_page)
     except Exception as e:
         st.error(f"List users failed: {e}")
         return []
@@ -146,6 +292,7 @@ def admin_invite_user(email: str, temp_password: str) -> Optional[str]:
     Creates a user with a temporary password and marks email as confirmed.
     The user should change password on first login (you can implement this via your own flow).
     """
+    supabase_admin = get_client_admin()
     if not supabase_admin:
         st.error("Admin functions require SUPABASE_SERVICE_ROLE_KEY in secrets.")
         return None
@@ -169,6 +316,7 @@ def admin_invite_user(email: str, temp_password: str) -> Optional[str]:
         return None
 
 def admin_delete_user(user_id: str) -> bool:
+    supabase_admin = get_client_admin()
     if not supabase_admin:
         st.error("Admin functions require SUPABASE_SERVICE_ROLE_KEY in secrets.")
         return False
@@ -203,6 +351,10 @@ def auth_block():
             if sign_up(email2, pw2):
                 st.success("Account created. Please sign in above.")
 
+def _load_admin_page(page: int):
+    st.session_state["admin_page"] = page
+    st.session_state["admin_users"] = admin_list_users(page)
+
 def admin_panel():
     st.header("🔐 Admin Panel")
     st.info("Admin features require `SUPABASE_SERVICE_ROLE_KEY` in secrets and your email in `ADMIN_EMAILS`.")
@@ -216,86 +368,115 @@ def admin_panel():
             else:
                 user_id = admin_invite_user(inv_email, inv_temp)
                 if user_id:
+                    _cached_list_users.clear()
+                    st.session_state.pop("admin_users", None)
                     st.success(f"User created with id: {user_id}")
 
-    # List & delete
+    # List & delete — fetched only on request, not on every admin rerun
     with st.expander("List / Delete Users"):
-        users = admin_list_users()
-        if users:
-            st.write(f"Total: {len(users)}")
-            for u in users:
-                uid = u.get("id")
-                uemail = (u.get("email") or "").lower()
-                st.write(f"- **{uemail}** — id: `{uid}`")
-                if st.button(f"Delete {uemail}", key=f"del_{uid}"):
-                    if admin_delete_user(uid):
-                        st.success(f"Deleted {uemail}")
+        page = st.session_state.get("admin_page", 1)
+        users = st.session_state.get("admin_users")
+        # One page of ADMIN_USERS_PER_PAGE users at a time
+        cols = st.columns(3)
+        with cols[0]:
+            st.button("Load users", key="admin_load_users", on_click=_load_admin_page, args=(page,))
+        with cols[1]:
+            st.button("Previous page", key="admin_prev_page", on_click=_load_admin_page, args=(page - 1,), disabled=users is None or page <= 1)
+        with cols[2]:
+            st.button("Next page", key="admin_next_page", on_click=_load_admin_page, args=(page + 1,), disabled=users is None or len(users) < ADMIN_USERS_PER_PAGE)
+        if users is None:
+            st.caption("Click **Load users** to fetch the user list.")
+        elif users:
+            import pandas as pd
+            # The Admin API has no email filter, so search narrows the current page
+            query = st.text_input("Search email", key="admin_user_search").strip().lower()
+            email_by_id = {u.get("id"): (u.get("email") or "").lower() for u in users}
+            if query:
+                email_by_id = {uid: email for uid, email in email_by_id.items() if query in email}
+            st.write(f"Page {page}: {len(email_by_id)} of {len(users)} users")
+            if not email_by_id:
+                st.write("No users match.")
+            else:
+                # One table + one selector/button instead of a button per user
+                st.dataframe(
+                    pd.DataFrame({"email": list(email_by_id.values()), "id": list(email_by_id.keys())}),
+                    hide_index=True,
+                    use_container_width=True,
+                )
+                target = st.selectbox("User to delete", options=list(email_by_id), format_func=lambda uid: email_by_id[uid], key="admin_del_target")
+                if st.button("Delete selected", key="admin_del_btn"):
+                    if admin_delete_user(target):
+                        _cached_list_users.clear()
+                        st.session_state.pop("admin_users", None)
+                        st.success(f"Deleted {email_by_id[target]}")
                         st.rerun()
         else:
             st.write("No users or failed to load.")
 
-def mcq_player(df: pd.DataFrame):
+def _set_quiz_index(idx: int):
+    st.session_state["quiz_index"] = idx
+
+# Runs as a fragment: quiz interactions rerun only this block, not all of main()
+@st.fragment
+def mcq_player(df: pd.DataFrame, path_str: str, mtime: Optional[float]):
+    import pandas as pd
     st.header("📚 AKT MCQ Practice")
     if df.empty:
         st.warning("No items found. Add lines to `data/items.jsonl`.")
         return
     # Filters
     with st.expander("Filters"):
-        domains = ["All"] + sorted([d for d in df["domain"].dropna().unique()])
-        sub_specs = ["All"] + sorted([d for d in df["sub_specialty"].dropna().unique()])
+        dom_values, sub_values = filter_choices(path_str, mtime, df)
+        domains = ["All"] + dom_values
+        sub_specs = ["All"] + sub_values
         dom_choice = st.selectbox("Domain", domains, index=0)
         sub_choice = st.selectbox("Sub-specialty", sub_specs, index=0)
 
-    filtered = df.copy()
-    if dom_choice != "All":
-        filtered = filtered[filtered["domain"] == dom_choice]
-    if sub_choice != "All":
-        filtered = filtered[filtered["sub_specialty"] == sub_choice]
+    # The session keeps only the filter signature; the matching rows live in one shared
+    # queue per signature, so renders index a plain list with no pandas work
+    st.session_state["filter_sig"] = (path_str, mtime, dom_choice, sub_choice)
+    queue = build_quiz_queue(*st.session_state["filter_sig"], df)
 
     # Quiz navigation
     idx = st.session_state["quiz_index"]
-    if idx >= len(filtered):
+    if idx >= len(queue):
         idx = 0
         st.session_state["quiz_index"] = 0
 
-    st.write(f"Items available: **{len(filtered)}**")
-    if len(filtered) == 0:
+    st.write(f"Items available: **{len(queue)}**")
+    if len(queue) == 0:
         return
 
-    row = filtered.iloc[idx]
+    row = queue[idx]
     case_id = row.get("case_id")
-    st.subheader(f"Question {idx+1} / {len(filtered)}  —  `{case_id}`")
+    st.subheader(f"Question {idx+1} / {len(queue)}  —  `{case_id}`")
     st.write(f"**Topic:** {row.get('topic', '')}")
     st.write(row.get("question", ""))
 
-    options = row.get("options", {})
-    # Keep stable order A-E
-    keys = ["A", "B", "C", "D", "E"]
-    labels = [f"{k}. {options[k]}" for k in keys if k in options]
-    key_to_label = {k: options[k] for k in keys if k in options}
+    # Stable A-E order comes from the per-key option columns
+    options = {k: row.get(f"options_{k}") for k in OPTION_KEYS if pd.notna(row.get(f"options_{k}"))}
+    key_list = list(options)
+    key_pos = {k: i for i, k in enumerate(key_list)}
 
-    prev_choice = st.session_state["responses"].get(case_id)
-    choice = st.radio("Select one:", options=list(key_to_label.keys()), format_func=lambda k: f"{k}. {key_to_label[k]}", index=(list(key_to_label.keys()).index(prev_choice) if prev_choice in key_to_label else 0), key=f"choice_{case_id}")
+    prev = st.session_state["responses"].get(case_id)
+    prev_choice = prev["choice"] if prev else None
+    choice = st.radio("Select one:", options=key_list, format_func=lambda k: f"{k}. {options[k]}", index=key_pos.get(prev_choice, 0), key=f"choice_{case_id}")
 
     cols = st.columns(3)
     with cols[0]:
         if st.button("Submit"):
-            st.session_state["responses"][case_id] = choice
-            if choice == row.get("correct_answer"):
-                st.session_state["quiz_score"] += 1
+            # Keyed by case_id, so re-submitting replaces the answer instead of re-scoring it
+            st.session_state["responses"][case_id] = {"choice": choice, "correct": choice == row.get("correct_answer")}
             st.success("Answer submitted. See explanation below.")
     with cols[1]:
-        if st.button("Previous"):
-            st.session_state["quiz_index"] = max(0, idx - 1)
-            st.rerun()
+        # Callbacks update the index before the fragment reruns, so no extra st.rerun()
+        st.button("Previous", on_click=_set_quiz_index, args=(max(0, idx - 1),))
     with cols[2]:
-        if st.button("Next"):
-            st.session_state["quiz_index"] = min(len(filtered) - 1, idx + 1)
-            st.rerun()
+        st.button("Next", on_click=_set_quiz_index, args=(min(len(queue) - 1, idx + 1),))
 
     # Feedback
     if st.session_state["responses"].get(case_id):
-        chosen = st.session_state["responses"][case_id]
+        chosen = st.session_state["responses"][case_id]["choice"]
         correct = row.get("correct_answer")
         if chosen == correct:
             st.success(f"✅ Correct: {correct}")
@@ -319,7 +500,9 @@ def mcq_player(df: pd.DataFrame):
                 st.write(f"- {r}")
 
     # Score
-    st.info(f"Score: {st.session_state['quiz_score']} / {len(st.session_state['responses'])}")
+    responses = st.session_state["responses"]
+    score = sum(1 for r in responses.values() if r["correct"])
+    st.info(f"Score: {score} / {len(responses)}")
 
 def profile_box():
     email = current_user_email()
@@ -334,6 +517,8 @@ def profile_box():
 def main():
     st.set_page_config(page_title="Dr. Yousra AKT/CSA", layout="wide")
     init_session()
+    if is_logged_in():
+        get_client_session()
     brand_header()
 
     tabs = ["Practice", "My Account"]
@@ -347,9 +532,10 @@ def main():
             st.warning("Please sign in to start practicing.")
             auth_block()
         else:
-            df = load_items(ITEMS_PATH)
+            mtime = items_mtime(ITEMS_PATH)
+            df = load_items(ITEMS_PATH, mtime)
             profile_box()
-            mcq_player(df)
+            mcq_player(df, str(ITEMS_PATH), mtime)
 
     with active[1]:
         if not is_logged_in():